@@ -1,10 +1,25 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import orjson
+import csv
+import io
+import asyncio
+import httpx
+import hashlib
+import gzip
+import diskcache
+import threading
+import faiss
+import numpy as np
 from urllib.parse import urlparse, parse_qs
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from selectolax.lexbor import LexborHTMLParser
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 import time
 
 # Configuración de la página
@@ -15,42 +30,331 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Selectores CSS de los elementos que suelen contener filtros
+_FILTER_SELECTORS = (
+    'div[class*="filter"]',
+    'aside[class*="sidebar"]',
+    'form[class*="filter"]',
+    'div[class*="facet"]',
+    'select[name]',
+    'input[type="checkbox"]',
+    'ul[class*="category"]',
+)
+# Todos los selectores en un único grupo: el árbol se recorre una sola vez
+_FILTER_SELECTOR_GROUP = ", ".join(_FILTER_SELECTORS)
+_MAX_FILTER_CHARS = 8000
+_MAX_SCAN_CHARS = 200_000
+# Por debajo de este tamaño se considera que la página no tiene filtros
+_MIN_FILTER_ELEMENTS_CHARS = 200
+
+def _empty_analysis():
+    """Análisis vacío para páginas sin elementos de filtro (no se consulta a OpenAI)"""
+    return {
+        "filters": {},
+        "active_filters": {},
+        "filter_count": 0,
+        "sort_options": [],
+        "current_sort": None,
+        "note": "no_filter_nodes_detected"
+    }
+
+# HTML estático que no parece contener filtros: hay que renderizar JavaScript
+_FILTER_MARKER_RE = re.compile(r'class="[^"]*(filter|facet|sidebar)', re.IGNORECASE)
+_MIN_STATIC_HTML_CHARS = 20_000
+
+def _needs_js_render(html_content: str):
+    """Indica si el HTML sin renderizar es demasiado pequeño o no tiene marcas de filtros"""
+    if len(html_content) < _MIN_STATIC_HTML_CHARS:
+        return True
+    return _FILTER_MARKER_RE.search(html_content, 0, _MAX_SCAN_CHARS) is None
+
+# Caché persistente del HTML obtenido con Zenrows (clave: SHA-256 de la URL)
+_HTML_CACHE = diskcache.Cache("./.zenrows_cache")
+HTML_CACHE_TTL = 3600  # segundos
+
+def _get_cached_html(cache_key: str):
+    """Devuelve el HTML guardado en caché (comprimido con gzip) o None"""
+    cached_html = _HTML_CACHE.get(cache_key)
+    if cached_html is None or isinstance(cached_html, str):
+        # Las entradas anteriores a la compresión se guardaban como texto
+        return cached_html
+    return gzip.decompress(cached_html).decode()
+
+def _set_cached_html(cache_key: str, html_content: str):
+    """Guarda el HTML en caché comprimido con gzip"""
+    _HTML_CACHE.set(cache_key, gzip.compress(html_content.encode()), expire=HTML_CACHE_TTL)
+
+# Caché de análisis de OpenAI: coincidencia exacta del prompt y, si no la hay,
+# coincidencia semántica de los elementos de filtro con el mismo dominio y parámetros.
+# Incrementar PROMPT_VERSION al modificar el prompt invalida las entradas previas.
+PROMPT_VERSION = "v2"
+OPENAI_MODEL = "gpt-4o-mini"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 1536
+SEMANTIC_CACHE_THRESHOLD = 0.95
+_ANALYSIS_CACHE = diskcache.Cache("./.openai_cache")
+ANALYSIS_CACHE_TTL = 7 * 24 * 3600  # segundos
+
+# Esquema de la respuesta, expuesto al modelo como una función a invocar
+FILTER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "filters": {
+            "type": "object",
+            "description": "Filtros de la página indexados por nombre (price, categories, brands, colors, sizes, rating, availability...)",
+            "additionalProperties": {
+                "type": "object",
+                "properties": {
+                    "type": {"type": "string", "enum": ["range", "select", "multiselect", "boolean"]},
+                    "options": {"type": "array", "items": {"type": "string"}},
+                    "selected": {"description": "Valor o valores aplicados actualmente"},
+                    "min": {"type": ["number", "null"]},
+                    "max": {"type": ["number", "null"]},
+                    "current_min": {"type": ["number", "null"]},
+                    "current_max": {"type": ["number", "null"]}
+                },
+                "required": ["type"]
+            }
+        },
+        "active_filters": {"type": "object"},
+        "filter_count": {"type": "integer"},
+        "sort_options": {"type": "array", "items": {"type": "string"}},
+        "current_sort": {"type": ["string", "null"]}
+    },
+    "required": ["filters", "active_filters", "filter_count", "sort_options", "current_sort"]
+}
+FILTER_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "emit_filters",
+            "description": "Devuelve los filtros extraídos de la página de ecommerce",
+            "parameters": FILTER_SCHEMA
+        }
+    }
+]
+
+# Variante del esquema para analizar varias páginas en una sola llamada
+BATCH_FILTER_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "emit_filters_batch",
+            "description": "Devuelve los filtros extraídos de cada página de ecommerce del lote",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "results": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "id": {"type": "integer"},
+                                "filters": FILTER_SCHEMA
+                            },
+                            "required": ["id", "filters"]
+                        }
+                    }
+                },
+                "required": ["results"]
+            }
+        }
+    }
+]
+BATCH_ANALYSIS_SIZE = 8  # páginas por llamada a OpenAI en el modo lote
+
+# Lotes enviados a la Batch API de OpenAI (clave: id del lote)
+_BATCH_JOBS = diskcache.Cache("./.openai_batches")
+BATCH_JOBS_TTL = 7 * 24 * 3600  # segundos
+
+_FILTER_TOOL_CHOICE = {"type": "function", "function": {"name": "emit_filters"}}
+_BATCH_FILTER_TOOL_CHOICE = {"type": "function", "function": {"name": "emit_filters_batch"}}
+
+# Partes fijas de los prompts; en cada llamada solo se interpolan URL, parámetros y HTML
+ANALYSIS_INSTRUCTIONS = """- Incluye solo los filtros presentes en la página, con su tipo (range, select, multiselect, boolean) y sus opciones.
+- Marca los valores aplicados actualmente y resúmelos en active_filters.
+- Añade las opciones de ordenamiento si las encuentras.
+"""
+_SYSTEM_MSG = {
+    "role": "system",
+    "content": "Eres un experto en análisis de páginas de ecommerce. Extraes filtros y los estructuras en formato JSON válido."
+}
+_USER_TEMPLATE = """Analiza esta página de ecommerce y devuelve sus filtros con la función emit_filters.
+
+URL: {url}
+Parámetros de URL detectados: {params}
+
+Elementos HTML relevantes:
+{html}
+
+""" + ANALYSIS_INSTRUCTIONS
+_BATCH_USER_TEMPLATE = """Analiza estas páginas de ecommerce y devuelve los filtros de cada una con la función emit_filters_batch, conservando el id de cada elemento.
+
+{items}
+
+""" + ANALYSIS_INSTRUCTIONS
+
+def _normalize_embedding(embedding):
+    """Convierte un embedding en un vector unitario apto para similitud coseno"""
+    vector = np.asarray([embedding], dtype="float32")
+    faiss.normalize_L2(vector)
+    return vector
+
+@st.cache_resource
+def _get_semantic_index():
+    """Índice FAISS de embeddings, reconstruido a partir de la caché en disco"""
+    index = faiss.IndexFlatIP(EMBEDDING_DIMENSIONS)
+    entries = []
+    for key in _ANALYSIS_CACHE.iterkeys():
+        entry = _ANALYSIS_CACHE.get(key)
+        if not entry or entry.get("embedding") is None:
+            continue
+        if entry.get("promptVersion") != PROMPT_VERSION:
+            continue
+        index.add(_normalize_embedding(entry["embedding"]))
+        entries.append((key, entry.get("scope")))
+    return {"index": index, "entries": entries, "lock": threading.Lock()}
+
+def _semantic_scope(url_params: dict):
+    """Ámbito de la caché semántica: mismo dominio y mismos parámetros de URL.
+    
+    Páginas que solo difieren en la query (p. ej. ?brand=acme frente a ?brand=foo)
+    tienen un HTML de filtros casi idéntico, pero distintos filtros activos.
+    """
+    return json.dumps(
+        [url_params.get("domain"), url_params.get("parameters", {})],
+        sort_keys=True,
+        ensure_ascii=False
+    )
+
+def _semantic_cache_lookup(embedding, scope: str):
+    """Busca un análisis previo con elementos de filtro casi idénticos en el mismo ámbito"""
+    semantic = _get_semantic_index()
+    with semantic["lock"]:
+        total = semantic["index"].ntotal
+        if total == 0:
+            return None
+        scores, ids = semantic["index"].search(_normalize_embedding(embedding), min(5, total))
+        candidates = [
+            semantic["entries"][idx]
+            for score, idx in zip(scores[0], ids[0])
+            if idx >= 0 and score >= SEMANTIC_CACHE_THRESHOLD
+        ]
+    
+    for key, entry_scope in candidates:
+        if entry_scope != scope:
+            continue
+        entry = _ANALYSIS_CACHE.get(key)
+        if entry is not None:
+            return entry["response"]
+    return None
+
+def _analysis_cache_key(messages: list):
+    """Clave de la caché exacta: mismos mensajes, modelo y versión del prompt"""
+    return hashlib.sha256(
+        "".join([message["content"] for message in messages] + [OPENAI_MODEL, PROMPT_VERSION]).encode()
+    ).hexdigest()
+
+def _store_analysis(cache_key: str, analysis: dict, embedding, scope: str):
+    """Guarda un análisis en la caché exacta y, si hay embedding, en la semántica"""
+    now = datetime.now()
+    entry = {
+        "response": analysis,
+        "promptVersion": PROMPT_VERSION,
+        "createdAt": now.isoformat(),
+        "expiresAt": (now + timedelta(seconds=ANALYSIS_CACHE_TTL)).isoformat(),
+        "scope": scope,
+        "embedding": embedding,
+    }
+    _ANALYSIS_CACHE.set(cache_key, entry, expire=ANALYSIS_CACHE_TTL)
+    
+    if embedding is not None:
+        semantic = _get_semantic_index()
+        with semantic["lock"]:
+            semantic["index"].add(_normalize_embedding(embedding))
+            semantic["entries"].append((cache_key, scope))
+
+@lru_cache(maxsize=2048)
+def _parse_url(url: str):
+    """Parsea una URL y su query; el resultado inmutable se memoriza entre ejecuciones"""
+    parsed_url = urlparse(url)
+    url_params = tuple(
+        (key, tuple(values)) for key, values in parse_qs(parsed_url.query).items()
+    )
+    return parsed_url, url_params
+
+def _hash_api_keys(zenrows_key: str, openai_key: str):
+    """Hash de las claves API para identificar al usuario sin guardar las claves en claro"""
+    return hashlib.sha256(f"{zenrows_key}:{openai_key}".encode()).hexdigest()
+
+def _serializable_url_analysis(url_analysis: dict):
+    """Copia del análisis de URL sin el objeto 'parsed', apta para JSON y para el prompt"""
+    return {key: value for key, value in url_analysis.items() if key != 'parsed'}
+
 class EcommerceFilterExtractor:
     def __init__(self, zenrows_api_key: str, openai_api_key: str):
         self.zenrows_api_key = zenrows_api_key
         self.openai_client = OpenAI(api_key=openai_api_key)
+        self.keys_hash = _hash_api_keys(zenrows_api_key, openai_api_key)
         self.zenrows_url = "https://api.zenrows.com/v1/"
+        
+        # Sesión compartida para reutilizar la conexión TLS con Zenrows
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=10,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=[429, 500, 502, 503, 504],
+                raise_on_status=False
+            )
+        ))
     
     def extract_url_parameters(self, url: str):
-        """Extrae parámetros directamente de la URL"""
-        parsed_url = urlparse(url)
-        url_params = parse_qs(parsed_url.query)
+        """Extrae parámetros directamente de la URL (incluye la URL ya parseada en 'parsed')"""
+        parsed_url, url_params = _parse_url(url)
         
         clean_params = {}
-        for key, values in url_params.items():
+        for key, values in url_params:
             if len(values) == 1:
                 clean_params[key] = values[0]
             else:
-                clean_params[key] = values
+                clean_params[key] = list(values)
         
         return {
+            'parsed': parsed_url,
             'domain': parsed_url.netloc,
             'path': parsed_url.path,
             'parameters': clean_params
         }
     
-    def scrape_page_content(self, url: str):
-        """Obtiene el contenido HTML usando Zenrows"""
+    def _zenrows_params(self, url: str, js_render: bool = False):
+        """Parámetros de la petición a Zenrows para una URL"""
         params = {
             'url': url,
             'apikey': self.zenrows_api_key,
-            'js_render': 'true',
-            'wait': 3000,
+            'js_render': 'true' if js_render else 'false',
         }
+        if js_render:
+            params['wait'] = 1500
+        return params
+    
+    def scrape_page_content(self, url: str, force_refresh: bool = False):
+        """Obtiene el contenido HTML usando Zenrows (con caché en disco)"""
+        cache_key = hashlib.sha256(url.encode()).hexdigest()
+        if not force_refresh:
+            cached_html = _get_cached_html(cache_key)
+            if cached_html is not None:
+                return cached_html
         
         try:
-            response = requests.get(self.zenrows_url, params=params, timeout=30)
+            # Primero sin renderizar JavaScript; solo se renderiza si no aparecen filtros
+            response = self._session.get(self.zenrows_url, params=self._zenrows_params(url), timeout=(5, 30))
+            if not response.ok or _needs_js_render(response.text):
+                response = self._session.get(self.zenrows_url, params=self._zenrows_params(url, js_render=True), timeout=(5, 30))
             response.raise_for_status()
+            _set_cached_html(cache_key, response.text)
             return response.text
         except requests.RequestException as e:
             st.error(f"Error al hacer scraping: {e}")
@@ -61,120 +365,121 @@ class EcommerceFilterExtractor:
         if not html_content:
             return ""
         
-        filter_patterns = [
-            r'<div[^>]*class="[^"]*filter[^"]*"[^>]*>.*?</div>',
-            r'<aside[^>]*class="[^"]*sidebar[^"]*"[^>]*>.*?</aside>',
-            r'<form[^>]*class="[^"]*filter[^"]*"[^>]*>.*?</form>',
-            r'<div[^>]*class="[^"]*facet[^"]*"[^>]*>.*?</div>',
-            r'<select[^>]*name="[^"]*"[^>]*>.*?</select>',
-            r'<input[^>]*type="checkbox"[^>]*>.*?(?=<input|</div>|</form>)',
-            r'<ul[^>]*class="[^"]*category[^"]*"[^>]*>.*?</ul>',
-        ]
+        # Solo se procesa el inicio del documento; el resultado se trunca igualmente
+        tree = LexborHTMLParser(html_content[:_MAX_SCAN_CHARS])
         
         extracted_elements = []
-        for pattern in filter_patterns:
-            matches = re.findall(pattern, html_content, re.DOTALL | re.IGNORECASE)
-            extracted_elements.extend(matches)
+        extracted_ids = set()
+        total_length = 0
+        for node in tree.css(_FILTER_SELECTOR_GROUP):
+            # Un nodo ya extraído (coincide con varios selectores del grupo) o dentro de
+            # un elemento ya extraído ya está incluido en su HTML
+            parent = node
+            while parent is not None and parent.mem_id not in extracted_ids:
+                parent = parent.parent
+            if parent is not None:
+                continue
+            
+            element = node.html
+            extracted_elements.append(element)
+            extracted_ids.add(node.mem_id)
+            total_length += len(element) + 1
+            # No seguir buscando una vez superado el límite de truncado
+            if total_length >= _MAX_FILTER_CHARS:
+                break
         
         content = ' '.join(extracted_elements)
-        return content[:8000]
+        return content[:_MAX_FILTER_CHARS]
+    
+    def embed_filter_elements(self, filter_elements: str):
+        """Obtiene el embedding de los elementos de filtro para la caché semántica"""
+        if not filter_elements:
+            return None
+        
+        try:
+            response = self.openai_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=filter_elements
+            )
+            return response.data[0].embedding
+        except Exception:
+            # Sin embedding simplemente se omite la caché semántica
+            return None
+    
+    def _build_analysis_messages(self, url: str, filter_elements: str, url_params: dict):
+        """Construye los mensajes del análisis de filtros"""
+        params_json = json.dumps(url_params, separators=(",", ":"), ensure_ascii=False)
+        return [
+            _SYSTEM_MSG,
+            {"role": "user", "content": _USER_TEMPLATE.format(url=url, params=params_json, html=filter_elements)}
+        ]
     
-    def analyze_with_openai(self, url: str, html_content: str, url_params: dict):
-        """Usa OpenAI para analizar el contenido"""
+    def analyze_with_openai(self, url: str, html_content: str, url_params: dict, progress_callback=None):
+        """Usa OpenAI para analizar el contenido, mostrando la respuesta en streaming"""
         filter_elements = self.extract_filter_elements(html_content)
         
-        prompt = f"""
-Analiza esta página de ecommerce y extrae todos los filtros disponibles de forma estructurada.
-
-URL: {url}
-Parámetros de URL detectados: {json.dumps(url_params, indent=2)}
-
-Elementos HTML relevantes:
-{filter_elements[:6000]}
-
-Extrae y estructura los filtros en el siguiente formato JSON:
-{{
-    "filters": {{
-        "price": {{
-            "type": "range",
-            "min": null,
-            "max": null,
-            "current_min": null,
-            "current_max": null
-        }},
-        "categories": {{
-            "type": "select",
-            "options": [],
-            "selected": []
-        }},
-        "brands": {{
-            "type": "multiselect",
-            "options": [],
-            "selected": []
-        }},
-        "colors": {{
-            "type": "multiselect",
-            "options": [],
-            "selected": []
-        }},
-        "sizes": {{
-            "type": "multiselect", 
-            "options": [],
-            "selected": []
-        }},
-        "rating": {{
-            "type": "range",
-            "min": 1,
-            "max": 5,
-            "current": null
-        }},
-        "availability": {{
-            "type": "boolean",
-            "options": ["in_stock", "out_of_stock"],
-            "selected": null
-        }}
-    }},
-    "active_filters": {{}},
-    "filter_count": 0,
-    "sort_options": [],
-    "current_sort": null
-}}
-
-Instrucciones:
-1. Identifica TODOS los filtros disponibles en la página
-2. Determina el tipo de cada filtro (range, select, multiselect, boolean)
-3. Extrae las opciones disponibles para cada filtro
-4. Identifica qué filtros están actualmente aplicados
-5. Incluye opciones de ordenamiento si las encuentras
-6. Si un filtro no existe en la página, no lo incluyas en la respuesta
-
-Responde SOLO con el JSON válido, sin explicaciones adicionales.
-"""
+        # Sin elementos de filtro no merece la pena llamar a OpenAI
+        if len(filter_elements) < _MIN_FILTER_ELEMENTS_CHARS:
+            return _empty_analysis()
+        
+        messages = self._build_analysis_messages(url, filter_elements, url_params)
+        
+        # Caché exacta: mismo prompt, modelo y versión del prompt
+        cache_key = _analysis_cache_key(messages)
+        cached = _ANALYSIS_CACHE.get(cache_key)
+        if cached is not None:
+            return cached["response"]
+        
+        # Caché semántica: elementos de filtro casi idénticos, mismo dominio y parámetros
+        scope = _semantic_scope(url_params)
+        embedding = self.embed_filter_elements(filter_elements)
+        if embedding is not None:
+            cached_analysis = _semantic_cache_lookup(embedding, scope)
+            if cached_analysis is not None:
+                return cached_analysis
 
         try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "Eres un experto en análisis de páginas de ecommerce. Extraes filtros y los estructuras en formato JSON válido."},
-                    {"role": "user", "content": prompt}
-                ],
+            stream = self.openai_client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
                 temperature=0.1,
-                max_tokens=2000
+                max_tokens=2000,
+                tools=FILTER_TOOLS,
+                tool_choice=_FILTER_TOOL_CHOICE,
+                stream=True
             )
             
-            content = response.choices[0].message.content.strip()
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                return json.loads(json_match.group())
-            else:
-                return json.loads(content)
+            # Mostrar la respuesta a medida que llega
+            chunks = []
+            preview = st.empty()
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                tool_calls = chunk.choices[0].delta.tool_calls
+                if not tool_calls or not tool_calls[0].function:
+                    continue
+                chunks.append(tool_calls[0].function.arguments or "")
+                preview.code("".join(chunks)[-2000:], language="json")
+                if progress_callback:
+                    progress_callback(75 + min(20, len(chunks) * 20 // 2000), "🤖 Analizando contenido con IA...")
+            preview.empty()
+            
+            # Los argumentos de la llamada a emit_filters son el JSON de filtros
+            analysis = json.loads("".join(chunks))
+            
+            _store_analysis(cache_key, analysis, embedding, scope)
+            return analysis
                 
         except Exception as e:
             st.error(f"Error al analizar con OpenAI: {e}")
             return {"error": str(e)}
     
-    def extract_filters(self, url: str, include_html_analysis: bool = True):
-        """Función principal para extraer filtros"""
+    def extract_filters(self, url: str, include_html_analysis: bool = True, force_refresh: bool = False, progress_callback=None, url_analysis: dict = None):
+        """Función principal para extraer filtros (reutiliza `url_analysis` si ya se calculó)"""
+        def report(percent, message):
+            if progress_callback:
+                progress_callback(percent, message)
+        
         result = {
             "url": url,
             "timestamp": datetime.now().isoformat(),
@@ -185,16 +490,21 @@ Responde SOLO con el JSON válido, sin explicaciones adicionales.
         
         try:
             # Extraer parámetros de la URL
-            url_analysis = self.extract_url_parameters(url)
+            report(25, "📊 Analizando URL...")
+            if url_analysis is None:
+                url_analysis = self.extract_url_parameters(url)
+            url_analysis = _serializable_url_analysis(url_analysis)
             result["url_analysis"] = url_analysis
             
             if include_html_analysis:
                 # Hacer scraping de la página
-                html_content = self.scrape_page_content(url)
+                report(50, "🕷️ Haciendo scraping de la página...")
+                html_content = self.scrape_page_content(url, force_refresh)
                 
                 if html_content:
                     # Analizar con OpenAI
-                    ai_analysis = self.analyze_with_openai(url, html_content, url_analysis)
+                    report(75, "🤖 Analizando contenido con IA...")
+                    ai_analysis = self.analyze_with_openai(url, html_content, url_analysis, progress_callback)
                     result["filters"] = ai_analysis
                     result["success"] = True
                 else:
@@ -207,6 +517,425 @@ Responde SOLO con el JSON válido, sin explicaciones adicionales.
             result["error"] = str(e)
         
         return result
+    
+    async def scrape_page_content_async(self, http_client: httpx.AsyncClient, url: str, force_refresh: bool = False):
+        """Versión asíncrona de scrape_page_content para el modo lote"""
+        cache_key = hashlib.sha256(url.encode()).hexdigest()
+        if not force_refresh:
+            cached_html = _get_cached_html(cache_key)
+            if cached_html is not None:
+                return cached_html
+        
+        try:
+            # Primero sin renderizar JavaScript; solo se renderiza si no aparecen filtros
+            response = await http_client.get(self.zenrows_url, params=self._zenrows_params(url))
+            if not response.is_success or _needs_js_render(response.text):
+                response = await http_client.get(self.zenrows_url, params=self._zenrows_params(url, js_render=True))
+            response.raise_for_status()
+            _set_cached_html(cache_key, response.text)
+            return response.text
+        except httpx.HTTPError as e:
+            st.error(f"Error al hacer scraping de {url}: {e}")
+            return None
+    
+    async def embed_filter_elements_async(self, openai_client: AsyncOpenAI, filter_elements: str):
+        """Versión asíncrona de embed_filter_elements para el modo lote"""
+        if not filter_elements:
+            return None
+        
+        try:
+            response = await openai_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=filter_elements
+            )
+            return response.data[0].embedding
+        except Exception:
+            # Sin embedding simplemente se omite la caché semántica
+            return None
+    
+    def _build_batch_analysis_messages(self, items: list):
+        """Construye los mensajes para analizar varias páginas en una sola llamada"""
+        items_json = json.dumps({"items": items}, separators=(",", ":"), ensure_ascii=False)
+        return [
+            _SYSTEM_MSG,
+            {"role": "user", "content": _BATCH_USER_TEMPLATE.format(items=items_json)}
+        ]
+    
+    async def analyze_batch_with_openai_async(self, openai_client: AsyncOpenAI, items: list):
+        """Analiza varias páginas (url, html, parámetros) con una sola llamada a OpenAI"""
+        analyses = [None] * len(items)
+        
+        # Caché exacta por página, con la misma clave que el análisis individual
+        candidates = []
+        for index, (url, html_content, url_params) in enumerate(items):
+            filter_elements = self.extract_filter_elements(html_content)
+            if len(filter_elements) < _MIN_FILTER_ELEMENTS_CHARS:
+                analyses[index] = _empty_analysis()
+                continue
+            
+            cache_key = _analysis_cache_key(self._build_analysis_messages(url, filter_elements, url_params))
+            cached = _ANALYSIS_CACHE.get(cache_key)
+            if cached is not None:
+                analyses[index] = cached["response"]
+            else:
+                candidates.append((index, url, filter_elements, url_params, cache_key))
+        
+        # Caché semántica para las páginas restantes
+        embeddings = await asyncio.gather(*[
+            self.embed_filter_elements_async(openai_client, candidate[2]) for candidate in candidates
+        ])
+        pending = []
+        for candidate, embedding in zip(candidates, embeddings):
+            index, url, filter_elements, url_params, cache_key = candidate
+            cached_analysis = None
+            if embedding is not None:
+                cached_analysis = _semantic_cache_lookup(embedding, _semantic_scope(url_params))
+            if cached_analysis is not None:
+                analyses[index] = cached_analysis
+            else:
+                pending.append((index, url, filter_elements, url_params, cache_key, embedding))
+        
+        if not pending:
+            return analyses
+        
+        batch_items = [
+            {"id": item_id, "url": url, "params": url_params, "html": filter_elements}
+            for item_id, (_, url, filter_elements, url_params, _, _) in enumerate(pending)
+        ]
+        
+        try:
+            response = await openai_client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=self._build_batch_analysis_messages(batch_items),
+                temperature=0.1,
+                max_tokens=min(2000 * len(pending), 16000),
+                tools=BATCH_FILTER_TOOLS,
+                tool_choice=_BATCH_FILTER_TOOL_CHOICE
+            )
+            
+        except Exception as e:
+            st.error(f"Error al analizar el lote con OpenAI: {e}")
+            for index, *_ in pending:
+                analyses[index] = {"error": str(e)}
+            return analyses
+        
+        # Repartir las respuestas por id; una respuesta truncada o inválida no invalida el grupo
+        try:
+            batch_analysis = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
+            results_by_id = {
+                item["id"]: item["filters"]
+                for item in batch_analysis["results"]
+                if isinstance(item.get("filters"), dict)
+            }
+        except (json.JSONDecodeError, KeyError, IndexError, TypeError, AttributeError):
+            results_by_id = {}
+        
+        retries = []
+        for item_id, (index, url, filter_elements, url_params, cache_key, embedding) in enumerate(pending):
+            analysis = results_by_id.get(item_id)
+            if analysis is None:
+                retries.append((index, url, filter_elements, url_params, cache_key, embedding))
+                continue
+            _store_analysis(cache_key, analysis, embedding, _semantic_scope(url_params))
+            analyses[index] = analysis
+        
+        # Las páginas sin respuesta válida se reintentan con una llamada por página
+        retried = await asyncio.gather(*[
+            self._analyze_page_async(openai_client, url, filter_elements, url_params)
+            for _, url, filter_elements, url_params, _, _ in retries
+        ])
+        for (index, _, _, url_params, cache_key, embedding), analysis in zip(retries, retried):
+            if "error" not in analysis:
+                _store_analysis(cache_key, analysis, embedding, _semantic_scope(url_params))
+            analyses[index] = analysis
+        
+        return analyses
+    
+    async def _analyze_page_async(self, openai_client: AsyncOpenAI, url: str, filter_elements: str, url_params: dict):
+        """Analiza una sola página sin streaming (reintento de las páginas de un grupo fallido)"""
+        try:
+            response = await openai_client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=self._build_analysis_messages(url, filter_elements, url_params),
+                temperature=0.1,
+                max_tokens=2000,
+                tools=FILTER_TOOLS,
+                tool_choice=_FILTER_TOOL_CHOICE
+            )
+            return json.loads(response.choices[0].message.tool_calls[0].function.arguments)
+        except Exception as e:
+            st.error(f"Error al analizar {url} con OpenAI: {e}")
+            return {"error": str(e)}
+    
+    def _prepare_results(self, urls: list, include_html_analysis: bool = True):
+        """Resultados iniciales (con el análisis de URL) para un lote de URLs"""
+        results = []
+        for url in urls:
+            result = {
+                "url": url,
+                "timestamp": datetime.now().isoformat(),
+                "url_analysis": {},
+                "filters": {},
+                "success": False
+            }
+            try:
+                result["url_analysis"] = _serializable_url_analysis(self.extract_url_parameters(url))
+                if not include_html_analysis:
+                    result["filters"] = {"url_parameters": result["url_analysis"]["parameters"]}
+                    result["success"] = True
+            except Exception as e:
+                result["error"] = str(e)
+            results.append(result)
+        return results
+    
+    async def scrape_many(self, urls: list, force_refresh: bool = False, limit: int = 10):
+        """Hace scraping de varias URLs en paralelo, con un máximo de `limit` a la vez"""
+        semaphore = asyncio.Semaphore(limit)
+        
+        # El cliente asíncrono se crea por lote: queda ligado al bucle de eventos de asyncio.run
+        async with httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(retries=3),
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+            timeout=httpx.Timeout(30, connect=5)
+        ) as http_client:
+            
+            async def scrape_one(url):
+                async with semaphore:
+                    return await self.scrape_page_content_async(http_client, url, force_refresh)
+            
+            return await asyncio.gather(*[scrape_one(url) for url in urls])
+    
+    async def extract_many(self, urls: list, include_html_analysis: bool = True, force_refresh: bool = False, limit: int = 10):
+        """Extrae filtros de varias URLs: scraping en paralelo y análisis agrupado por llamadas"""
+        results = self._prepare_results(urls, include_html_analysis)
+        if not include_html_analysis:
+            return results
+        
+        to_scrape = [result for result in results if "error" not in result]
+        html_contents = await self.scrape_many([result["url"] for result in to_scrape], force_refresh, limit)
+        
+        to_analyze = []
+        for result, html_content in zip(to_scrape, html_contents):
+            if html_content:
+                to_analyze.append((result, html_content))
+            else:
+                result["error"] = "No se pudo obtener el contenido de la página"
+        
+        semaphore = asyncio.Semaphore(limit)
+        async with AsyncOpenAI(api_key=self.openai_client.api_key) as openai_client:
+            
+            # Una llamada a OpenAI por cada grupo de BATCH_ANALYSIS_SIZE páginas
+            async def analyze_group(group):
+                async with semaphore:
+                    return await self.analyze_batch_with_openai_async(
+                        openai_client,
+                        [(result["url"], html_content, result["url_analysis"]) for result, html_content in group]
+                    )
+            
+            groups = [
+                to_analyze[start:start + BATCH_ANALYSIS_SIZE]
+                for start in range(0, len(to_analyze), BATCH_ANALYSIS_SIZE)
+            ]
+            group_analyses = await asyncio.gather(*[analyze_group(group) for group in groups])
+        
+        for group, analyses in zip(groups, group_analyses):
+            for (result, _), analysis in zip(group, analyses):
+                result["filters"] = analysis
+                result["success"] = True
+        
+        return results
+    
+    def submit_batch(self, urls: list, force_refresh: bool = False):
+        """Envía el análisis de varias URLs a la Batch API de OpenAI.
+        
+        Devuelve (id del lote, resultados). Si no queda ninguna página por enviar
+        (todas en caché o sin filtros) no se crea lote y el id es None.
+        """
+        results = self._prepare_results(urls)
+        to_scrape = [(index, result) for index, result in enumerate(results) if "error" not in result]
+        html_contents = asyncio.run(self.scrape_many([result["url"] for _, result in to_scrape], force_refresh))
+        
+        # Una petición por página; las que ya están en la caché exacta no se envían
+        requests_by_id = {}
+        lines = []
+        for (index, result), html_content in zip(to_scrape, html_contents):
+            if not html_content:
+                result["error"] = "No se pudo obtener el contenido de la página"
+                continue
+            
+            filter_elements = self.extract_filter_elements(html_content)
+            if len(filter_elements) < _MIN_FILTER_ELEMENTS_CHARS:
+                result["filters"] = _empty_analysis()
+                result["success"] = True
+                continue
+            
+            messages = self._build_analysis_messages(result["url"], filter_elements, result["url_analysis"])
+            cache_key = _analysis_cache_key(messages)
+            cached = _ANALYSIS_CACHE.get(cache_key)
+            if cached is not None:
+                result["filters"] = cached["response"]
+                result["success"] = True
+                continue
+            
+            custom_id = str(index)
+            requests_by_id[custom_id] = {"cache_key": cache_key, "scope": _semantic_scope(result["url_analysis"])}
+            lines.append(json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": OPENAI_MODEL,
+                    "messages": messages,
+                    "temperature": 0.1,
+                    "max_tokens": 2000,
+                    "tools": FILTER_TOOLS,
+                    "tool_choice": _FILTER_TOOL_CHOICE
+                }
+            }, ensure_ascii=False))
+        
+        if not lines:
+            return None, results
+        
+        batch_file = self.openai_client.files.create(
+            file=("filtros_lote.jsonl", "\n".join(lines).encode()),
+            purpose="batch"
+        )
+        batch = self.openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        
+        _BATCH_JOBS.set(batch.id, {
+            "batch_id": batch.id,
+            "created_at": datetime.now().isoformat(),
+            "keys_hash": self.keys_hash,
+            "results": results,
+            "requests": requests_by_id
+        }, expire=BATCH_JOBS_TTL)
+        return batch.id, results
+    
+    def get_batch_status(self, batch_id: str):
+        """Consulta el estado de un lote de la Batch API"""
+        return self.openai_client.batches.retrieve(batch_id)
+    
+    def fetch_batch_results(self, batch_id: str):
+        """Descarga los resultados de un lote completado y los asocia a sus URLs"""
+        job = _BATCH_JOBS.get(batch_id)
+        if job is None or job.get("keys_hash") != self.keys_hash:
+            raise ValueError(f"Lote desconocido: {batch_id}")
+        
+        batch = self.get_batch_status(batch_id)
+        results = job["results"]
+        
+        output_lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                output_lines.extend(self.openai_client.files.content(file_id).text.splitlines())
+        
+        for line in output_lines:
+            if not line.strip():
+                continue
+            output = json.loads(line)
+            request_info = job["requests"].get(output["custom_id"])
+            if request_info is None:
+                continue
+            result = results[int(output["custom_id"])]
+            
+            response = output.get("response") or {}
+            if output.get("error") or response.get("status_code") != 200:
+                result["error"] = str(output.get("error") or response.get("body"))
+                continue
+            
+            try:
+                tool_call = response["body"]["choices"][0]["message"]["tool_calls"][0]
+                analysis = json.loads(tool_call["function"]["arguments"])
+            except (KeyError, IndexError, json.JSONDecodeError) as e:
+                result["error"] = f"Respuesta no válida de OpenAI: {e}"
+                continue
+            
+            _store_analysis(request_info["cache_key"], analysis, None, request_info["scope"])
+            result["filters"] = analysis
+            result["success"] = True
+        
+        for custom_id in job["requests"]:
+            result = results[int(custom_id)]
+            if not result["success"] and "error" not in result:
+                result["error"] = "El lote no devolvió resultados para esta página"
+        
+        return results
+
+# Acotado: en un despliegue compartido cada par de claves mantiene vivos sus clientes
+@st.cache_resource(max_entries=20, ttl=3600)
+def get_extractor(keys_hash: str, _zenrows_key: str, _openai_key: str):
+    """Extractor compartido entre ejecuciones mientras no cambien las claves API"""
+    return EcommerceFilterExtractor(_zenrows_key, _openai_key)
+
+def _get_extractor_for_keys(zenrows_key: str, openai_key: str):
+    """Obtiene el extractor en caché usando un hash de las claves (nunca las claves en claro)"""
+    return get_extractor(_hash_api_keys(zenrows_key, openai_key), zenrows_key, openai_key)
+
+def read_csv_urls(csv_file):
+    """Extrae las URLs de un CSV subido (la primera URL válida de cada fila)"""
+    raw_content = csv_file.getvalue()
+    try:
+        content = raw_content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        # Exportaciones de Excel en Windows (cp1252/latin-1)
+        content = raw_content.decode("latin-1")
+    
+    # Una URL por línea: no se separa en columnas, las queries suelen llevar comas (?color=red,blue)
+    lines = [line.strip() for line in content.splitlines() if line.strip()]
+    if lines and all(line.lower().startswith(("http://", "https://")) for line in lines):
+        rows = [[line] for line in lines]
+    else:
+        # Excel con configuración regional española separa las columnas con ';'. No se usa
+        # csv.Sniffer: las comas de las queries lo confunden al elegir el separador
+        delimiter = ","
+        for candidate in (";", "\t"):
+            if all(candidate in line for line in lines):
+                delimiter = candidate
+                break
+        rows = csv.reader(io.StringIO(content), delimiter=delimiter)
+    
+    urls = []
+    for row in rows:
+        for cell in row:
+            cell = cell.strip()
+            parsed = urlparse(cell)
+            if parsed.scheme in ("http", "https") and parsed.netloc:
+                urls.append(cell)
+                break
+    return urls
+
+def show_batch_results(results: list, key: str):
+    """Muestra el resumen y la descarga de los resultados de un lote"""
+    success_count = sum(1 for batch_result in results if batch_result["success"])
+    st.success(f"✅ Lote completado: {success_count}/{len(results)} URLs analizadas")
+    
+    st.dataframe(
+        [
+            {
+                "URL": batch_result["url"],
+                "Éxito": batch_result["success"],
+                "Filtros": len(batch_result["filters"].get("filters", {})),
+                "Error": batch_result.get("error", "")
+            }
+            for batch_result in results
+        ],
+        use_container_width=True
+    )
+    
+    # Sin expander: esta vista también se muestra dentro del expander de cada lote
+    st.json(results, expanded=False)
+    
+    st.download_button(
+        label="📥 Descargar JSON del lote",
+        data=orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS),
+        file_name=f"filtros_lote_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+        mime="application/json",
+        key=f"download_{key}"
+    )
 
 def main():
     st.title("🛒 Extractor de Filtros de Ecommerce")
@@ -234,6 +963,11 @@ def main():
         # Opciones de análisis
         st.header("🔧 Opciones")
         include_html = st.checkbox("Análisis completo (HTML)", value=True)
+        force_refresh = st.checkbox(
+            "Forzar actualización",
+            value=False,
+            help="Ignora el HTML guardado en caché y vuelve a hacer scraping"
+        )
         
         if not include_html:
             st.info("Solo se analizarán los parámetros de la URL")
@@ -289,33 +1023,26 @@ def main():
     # Procesar análisis
     if analyze_button and url and zenrows_key and openai_key:
         try:
-            # Validar URL
-            parsed = urlparse(url)
-            if not parsed.scheme or not parsed.netloc:
-                st.error("❌ URL no válida")
-                return
-            
             # Crear extractor
             with st.spinner("🔄 Inicializando extractor..."):
-                extractor = EcommerceFilterExtractor(zenrows_key, openai_key)
+                extractor = _get_extractor_for_keys(zenrows_key, openai_key)
+            
+            # Validar URL (el análisis se reutiliza en la extracción)
+            url_analysis = extractor.extract_url_parameters(url)
+            if not url_analysis["parsed"].scheme or not url_analysis["parsed"].netloc:
+                st.error("❌ URL no válida")
+                return
             
             # Mostrar progreso
             progress_bar = st.progress(0)
             status_text = st.empty()
             
-            # Análisis
-            status_text.text("📊 Analizando URL...")
-            progress_bar.progress(25)
-            
-            if include_html:
-                status_text.text("🕷️ Haciendo scraping de la página...")
-                progress_bar.progress(50)
-                
-                status_text.text("🤖 Analizando contenido con IA...")
-                progress_bar.progress(75)
+            def update_progress(percent, message):
+                progress_bar.progress(percent)
+                status_text.text(message)
             
             # Extraer filtros
-            result = extractor.extract_filters(url, include_html)
+            result = extractor.extract_filters(url, include_html, force_refresh, update_progress, url_analysis)
             
             progress_bar.progress(100)
             status_text.text("✅ Análisis completado!")
@@ -375,11 +1102,11 @@ def main():
                     st.json(result)
                     
                     # Botón para descargar
-                    json_str = json.dumps(result, indent=2, ensure_ascii=False)
+                    json_bytes = orjson.dumps(result, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
                     st.download_button(
                         label="📥 Descargar JSON",
-                        data=json_str,
-                        file_name=f"filtros_{parsed.netloc}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                        data=json_bytes,
+                        file_name=f"filtros_{url_analysis['domain']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
                         mime="application/json"
                     )
             
@@ -390,6 +1117,112 @@ def main():
         except Exception as e:
             st.error(f"❌ Error inesperado: {str(e)}")
     
+    # Análisis por lotes
+    st.markdown("---")
+    st.header("📦 Análisis por Lotes")
+    
+    parallel_tab, batch_api_tab = st.tabs(["⚡ En paralelo", "🗂️ Batch API (diferido)"])
+    
+    with parallel_tab:
+        batch_input = st.text_area(
+            "Introduce varias URLs (una por línea):",
+            placeholder="https://ejemplo.com/categoria/zapatos\nhttps://ejemplo.com/categoria/camisetas",
+            help="Las URLs se analizan en paralelo"
+        )
+        batch_urls = [line.strip() for line in batch_input.splitlines() if line.strip()]
+        
+        batch_button = st.button(
+            "📦 Analizar Lote",
+            disabled=not (batch_urls and zenrows_key and openai_key)
+        )
+        
+        if batch_button and batch_urls and zenrows_key and openai_key:
+            try:
+                # Validar URLs
+                invalid_urls = []
+                for batch_url in batch_urls:
+                    parsed_batch_url = urlparse(batch_url)
+                    if not parsed_batch_url.scheme or not parsed_batch_url.netloc:
+                        invalid_urls.append(batch_url)
+                if invalid_urls:
+                    st.error(f"❌ URLs no válidas: {', '.join(invalid_urls)}")
+                else:
+                    with st.spinner(f"🔄 Analizando {len(batch_urls)} URLs en paralelo..."):
+                        extractor = _get_extractor_for_keys(zenrows_key, openai_key)
+                        results = asyncio.run(extractor.extract_many(batch_urls, include_html, force_refresh))
+                    
+                    show_batch_results(results, "parallel")
+            
+            except Exception as e:
+                st.error(f"❌ Error inesperado: {str(e)}")
+    
+    with batch_api_tab:
+        st.markdown(
+            "Para listas grandes de URLs: el análisis se procesa en diferido con la "
+            "Batch API de OpenAI (hasta 24 h, a mitad de precio)."
+        )
+        
+        csv_file = st.file_uploader(
+            "Sube un CSV con las URLs:",
+            type=["csv"],
+            help="Una URL por línea, o se usa la primera celda de cada fila que contenga una URL válida"
+        )
+        csv_urls = []
+        if csv_file:
+            try:
+                csv_urls = read_csv_urls(csv_file)
+                st.caption(f"{len(csv_urls)} URLs encontradas en el CSV")
+            except Exception as e:
+                st.error(f"❌ No se pudo leer el CSV: {str(e)}")
+        
+        submit_button = st.button(
+            "🗂️ Enviar a la Batch API",
+            disabled=not (csv_urls and zenrows_key and openai_key)
+        )
+        
+        if submit_button and csv_urls and zenrows_key and openai_key:
+            try:
+                with st.spinner(f"🕷️ Haciendo scraping de {len(csv_urls)} URLs y enviando el lote..."):
+                    extractor = _get_extractor_for_keys(zenrows_key, openai_key)
+                    batch_id, results = extractor.submit_batch(csv_urls, force_refresh)
+                if batch_id:
+                    st.success(f"✅ Lote enviado: {batch_id}")
+                else:
+                    st.info("ℹ️ No había páginas pendientes de analizar: se muestran los resultados disponibles")
+                    show_batch_results(results, "batch_api_cached")
+            except Exception as e:
+                st.error(f"❌ Error al enviar el lote: {str(e)}")
+        
+        # Lotes enviados anteriormente con las mismas claves API
+        if zenrows_key and openai_key:
+            keys_hash = _hash_api_keys(zenrows_key, openai_key)
+            jobs = sorted(
+                (
+                    job for job in (_BATCH_JOBS.get(batch_id) for batch_id in _BATCH_JOBS.iterkeys())
+                    if job is not None and job.get("keys_hash") == keys_hash
+                ),
+                key=lambda job: job["created_at"],
+                reverse=True
+            )
+            for job in jobs:
+                batch_id = job["batch_id"]
+                with st.expander(f"🗂️ {batch_id} · {len(job['results'])} URLs · {job['created_at'][:16]}"):
+                    if st.button("🔄 Consultar estado", key=f"status_{batch_id}"):
+                        try:
+                            extractor = _get_extractor_for_keys(zenrows_key, openai_key)
+                            batch = extractor.get_batch_status(batch_id)
+                            
+                            counts = batch.request_counts
+                            st.write("**Estado:**", batch.status)
+                            if counts and counts.total:
+                                st.progress(counts.completed / counts.total)
+                                st.caption(f"{counts.completed}/{counts.total} peticiones completadas, {counts.failed} fallidas")
+                            
+                            if batch.status == "completed":
+                                show_batch_results(extractor.fetch_batch_results(batch_id), batch_id)
+                        except Exception as e:
+                            st.error(f"❌ Error al consultar el lote: {str(e)}")
+    
     # Footer
     st.markdown("---")
     st.markdown(